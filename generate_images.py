@@ -3,10 +3,17 @@
 import asyncio
 import os
 import re
+from pathlib import Path
+from typing import Dict
 
-import aiohttp
+from github_stats import Stats, create_session
 
-from github_stats import Stats
+
+# Templates never change during a run, so read them once at import time
+TEMPLATE_DIR = Path(__file__).resolve().parent / "templates"
+OVERVIEW_TEMPLATE = (TEMPLATE_DIR / "overview.svg").read_text()
+LANGUAGES_TEMPLATE = (TEMPLATE_DIR / "languages.svg").read_text()
+PLACEHOLDER_RE = re.compile(r"{{\s*(\w+)\s*}}")
 
 
 ################################################################################
@@ -17,8 +24,18 @@ def generate_output_folder() -> None:
     """
     Create the output folder if it does not already exist
     """
-    if not os.path.isdir("generated"):
-        os.mkdir("generated")
+    os.makedirs("generated", exist_ok=True)
+
+
+def fill_template(template: str, values: Dict[str, str]) -> str:
+    """
+    Replace every "{{ key }}" placeholder in a template in a single pass
+    :param template: template text containing placeholders
+    :param values: replacement text for each placeholder key
+    :return: template with all known placeholders substituted
+    """
+    return PLACEHOLDER_RE.sub(lambda m: values.get(m.group(1), m.group(0)),
+                              template)
 
 
 ################################################################################
@@ -30,18 +47,17 @@ async def generate_overview(s: Stats) -> None:
     Generate an SVG badge with summary statistics
     :param s: Represents user's GitHub statistics
     """
-    with open("templates/overview.svg", "r") as f:
-        output = f.read()
-
-    output = re.sub("{{ name }}", await s.name, output)
-    output = re.sub("{{ stars }}", f"{await s.stargazers:,}", output)
-    output = re.sub("{{ forks }}", f"{await s.forks:,}", output)
-    output = re.sub("{{ contributions }}", f"{await s.total_contributions:,}",
-                    output)
+    values = {
+        "name": await s.name,
+        "stars": f"{await s.stargazers:,}",
+        "forks": f"{await s.forks:,}",
+        "contributions": f"{await s.total_contributions:,}",
+    }
     changed = (await s.lines_changed)[0] + (await s.lines_changed)[1]
-    output = re.sub("{{ lines_changed }}", f"{changed:,}", output)
-    output = re.sub("{{ views }}", f"{await s.views:,}", output)
-    output = re.sub("{{ repos }}", f"{len(await s.all_repos):,}", output)
+    values["lines_changed"] = f"{changed:,}"
+    values["views"] = f"{await s.views:,}"
+    values["repos"] = f"{len(await s.all_repos):,}"
+    output = fill_template(OVERVIEW_TEMPLATE, values)
 
     generate_output_folder()
     with open("generated/overview.svg", "w") as f:
@@ -53,11 +69,8 @@ async def generate_languages(s: Stats) -> None:
     Generate an SVG badge with summary languages used
     :param s: Represents user's GitHub statistics
     """
-    with open("templates/languages.svg", "r") as f:
-        output = f.read()
-
-    progress = ""
-    lang_list = ""
+    progress = []
+    lang_list = []
     sorted_languages = sorted((await s.languages).items(), reverse=True,
                               key=lambda t: t[1].get("size"))
     delay_between = 150
@@ -69,11 +82,11 @@ async def generate_languages(s: Stats) -> None:
             ratio = [.99, .01]
         if i == len(sorted_languages) - 1:
             ratio = [1, 0]
-        progress += (f'<span style="background-color: {color};'
-                     f'width: {(ratio[0] * data.get("prop", 0)):0.3f}%;'
-                     f'margin-right: {(ratio[1] * data.get("prop", 0)):0.3f}%;" '
-                     f'class="progress-item"></span>')
-        lang_list += f"""
+        progress.append(f'<span style="background-color: {color};'
+                        f'width: {(ratio[0] * data.get("prop", 0)):0.3f}%;'
+                        f'margin-right: {(ratio[1] * data.get("prop", 0)):0.3f}%;" '
+                        f'class="progress-item"></span>')
+        lang_list.append(f"""
 <li style="animation-delay: {i * delay_between}ms;">
 <svg xmlns="http://www.w3.org/2000/svg" class="octicon" style="fill:{color};"
 viewBox="0 0 16 16" version="1.1" width="16" height="16"><path
@@ -82,10 +95,12 @@ fill-rule="evenodd" d="M8 4a4 4 0 100 8 4 4 0 000-8z"></path></svg>
 <span class="percent">{data.get("prop", 0):0.2f}%</span>
 </li>
 
-"""
+""")
 
-    output = re.sub(r"{{ progress }}", progress, output)
-    output = re.sub(r"{{ lang_list }}", lang_list, output)
+    output = fill_template(LANGUAGES_TEMPLATE, {
+        "progress": "".join(progress),
+        "lang_list": "".join(lang_list),
+    })
 
     generate_output_folder()
     with open("generated/languages.svg", "w") as f:
@@ -112,7 +127,7 @@ async def main() -> None:
     exclude_langs = ({x.strip() for x in exclude_langs.split(",")}
                      if exclude_langs else None)
     consider_forked_repos = len(os.getenv("COUNT_STATS_FROM_FORKS")) != 0
-    async with aiohttp.ClientSession() as session:
+    async with create_session() as session:
         s = Stats(user, access_token, session, exclude_repos=exclude_repos,
                   exclude_langs=exclude_langs,
                   consider_forked_repos=consider_forked_repos)
@@ -1,11 +1,22 @@
 #!/usr/bin/python3
 
 import asyncio
+import hashlib
 import os
+import time
+from datetime import date
 from typing import Dict, List, Optional, Set, Tuple
 
 import aiohttp
-import requests
+import orjson
+
+
+# Directory for cached GraphQL responses when running this module locally.
+# Cached responses hold private repository data in plaintext, so the cache is
+# a local-development aid only and generate_images.py does not enable it.
+# Resolved next to this script so it does not depend on the working directory
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         ".github_stats_cache")
 
 
 ###############################################################################
@@ -19,36 +30,122 @@ class Queries(object):
     """
 
     def __init__(self, username: str, access_token: str,
-                 session: aiohttp.ClientSession, max_connections: int = 10):
+                 session: aiohttp.ClientSession, max_connections: int = 10,
+                 max_retries: int = 3,
+                 cache_dir: Optional[str] = None,
+                 cache_ttl: int = 60 * 60):
         self.username = username
         self.access_token = access_token
         self.session = session
+        self.graphql_headers = {
+            "Authorization": f"Bearer {access_token}",
+            "Content-Type": "application/json",
+        }
+        self.rest_headers = {"Authorization": f"token {access_token}"}
         self.semaphore = asyncio.Semaphore(max_connections)
+        self.max_retries = max_retries
+        self.cache_dir = cache_dir
+        self.cache_ttl = cache_ttl
+        # Queries are viewer-scoped, so responses depend on the token rather
+        # than on the username
+        self._token_id = hashlib.sha1(
+            str(access_token).encode()).hexdigest()[:16]
+
+    def _cache_path(self, generated_query: str) -> Optional[str]:
+        """
+        :param generated_query: GraphQL query the cached response belongs to
+        :return: path of the cache file for this query today, or None if
+                 caching is disabled
+        """
+        if self.cache_dir is None:
+            return None
+        digest = hashlib.sha1(generated_query.encode()).hexdigest()[:16]
+        return os.path.join(self.cache_dir,
+                            f"{self._token_id}-{date.today()}-{digest}.json")
+
+    def _read_cache(self, path: Optional[str]) -> Optional[Dict]:
+        """
+        :param path: cache file to read
+        :return: cached GraphQL response, or None if missing or expired
+        """
+        if path is None:
+            return None
+        try:
+            if time.time() - os.path.getmtime(path) > self.cache_ttl:
+                return None
+            with open(path, "rb") as f:
+                return orjson.loads(f.read())
+        except (OSError, ValueError):
+            return None
+
+    def _write_cache(self, path: Optional[str], result: Dict) -> None:
+        """
+        Store a successful GraphQL response so identical queries made later
+        today do not need to hit the API again
+        :param path: cache file to write
+        :param result: decoded GraphQL JSON output
+        """
+        if (path is None or not isinstance(result, dict)
+                or "data" not in result or "errors" in result):
+            return
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            self._prune_cache()
+            with open(path, "wb") as f:
+                f.write(orjson.dumps(result))
+        except OSError:
+            print("Failed to write GraphQL response cache")
+
+    def _prune_cache(self) -> None:
+        """
+        Delete this token's cached responses that are older than the cache
+        lifetime. Files not written by this cache are never touched.
+        """
+        now = time.time()
+        prefix = f"{self._token_id}-"
+        for entry in os.scandir(self.cache_dir):
+            if not (entry.name.startswith(prefix)
+                    and entry.name.endswith(".json")):
+                continue
+            try:
+                if now - entry.stat().st_mtime > self.cache_ttl:
+                    os.remove(entry.path)
+            except OSError:
+                continue
 
     async def query(self, generated_query: str) -> Dict:
         """
         Make a request to the GraphQL API using the authentication token from
-        the environment
+        the environment. Responses are cached on disk for a short time.
         :param generated_query: string query to be sent to the API
         :return: decoded GraphQL JSON output
         """
-        headers = {
-            "Authorization": f"Bearer {self.access_token}",
-        }
-        try:
-            async with self.semaphore:
-                r = await self.session.post("https://api.github.com/graphql",
-                                            headers=headers,
-                                            json={"query": generated_query})
-            return await r.json()
-        except:
-            print("aiohttp failed for GraphQL query")
-            # Fall back on non-async requests
-            async with self.semaphore:
-                r = requests.post("https://api.github.com/graphql",
-                                  headers=headers,
-                                  json={"query": generated_query})
-                return r.json()
+        cache_path = self._cache_path(generated_query)
+        cached = self._read_cache(cache_path)
+        if cached is not None:
+            return cached
+
+        failures = 0
+        while True:
+            try:
+                async with self.semaphore:
+                    r = await self.session.post(
+                        "https://api.github.com/graphql",
+                        headers=self.graphql_headers,
+                        data=orjson.dumps({"query": generated_query})
+                    )
+                result = orjson.loads(await r.read())
+                break
+            except Exception:
+                failures += 1
+                if failures >= self.max_retries:
+                    print("aiohttp failed too many times for GraphQL query. "
+                          "Data will be incomplete.")
+                    return dict()
+                print("aiohttp failed for GraphQL query. Retrying...")
+                await asyncio.sleep(2 ** (failures - 1))
+        self._write_cache(cache_path, result)
+        return result
 
     async def query_rest(self, path: str, params: Optional[Dict] = None) -> Dict:
         """
@@ -57,53 +154,78 @@ class Queries(object):
         :param params: Query parameters to be passed to the API
         :return: deserialized REST JSON output
         """
+        if params is None:
+            params = dict()
+        if path.startswith("/"):
+            path = path[1:]
+        url = f"https://api.github.com/{path}"
+        query_params = tuple(params.items())
 
+        failures = 0
         for _ in range(60):
-            headers = {
-                "Authorization": f"token {self.access_token}",
-            }
-            if params is None:
-                params = dict()
-            if path.startswith("/"):
-                path = path[1:]
             try:
                 async with self.semaphore:
-                    r = await self.session.get(f"https://api.github.com/{path}",
-                                               headers=headers,
-                                               params=tuple(params.items()))
+                    r = await self.session.get(url,
+                                               headers=self.rest_headers,
+                                               params=query_params)
                 if r.status == 202:
                     # print(f"{path} returned 202. Retrying...")
                     print(f"A path returned 202. Retrying...")
                     await asyncio.sleep(2)
                     continue
 
-                result = await r.json()
+                body = await r.read()
+                result = orjson.loads(body) if body.strip() else None
                 if result is not None:
                     return result
-            except:
-                print("aiohttp failed for rest query")
-                # Fall back on non-async requests
-                async with self.semaphore:
-                    r = requests.get(f"https://api.github.com/{path}",
-                                     headers=headers,
-                                     params=tuple(params.items()))
-                    if r.status_code == 202:
-                        print(f"A path returned 202. Retrying...")
-                        await asyncio.sleep(2)
-                        continue
-                    elif r.status_code == 200:
-                        return r.json()
+            except Exception:
+                failures += 1
+                if failures >= self.max_retries:
+                    print("aiohttp failed too many times for rest query. "
+                          "Data will be incomplete.")
+                    return dict()
+                print("aiohttp failed for rest query. Retrying...")
+                await asyncio.sleep(2 ** (failures - 1))
         # print(f"There were too many 202s. Data for {path} will be incomplete.")
         print("There were too many 202s. Data for this repository will be incomplete.")
         return dict()
 
+    @staticmethod
+    def minify(query: str) -> str:
+        """
+        Collapse the indentation of a generated query so it is not sent over
+        the wire. Only safe for queries whose string arguments contain no
+        whitespace, which holds for every query built by this class.
+        :param query: indented GraphQL query
+        :return: query with each run of whitespace replaced by a single space
+        """
+        return " ".join(query.split())
+
     @staticmethod
     def repos_overview(contrib_cursor: Optional[str] = None,
-                       owned_cursor: Optional[str] = None) -> str:
+                       owned_cursor: Optional[str] = None,
+                       contrib_details: bool = True) -> str:
         """
+        :param contrib_details: whether to fetch stars, forks, and languages
+                                for contributed repositories, or only their
+                                names
         :return: GraphQL query with overview of user repositories
         """
-        return f"""{{
+        repo_details = """
+        stargazers {
+          totalCount
+        }
+        forkCount
+        languages(first: 10, orderBy: {field: SIZE, direction: DESC}) {
+          edges {
+            size
+            node {
+              name
+              color
+            }
+          }
+        }"""
+        return Queries.minify(f"""{{
   viewer {{
     login,
     name,
@@ -121,20 +243,7 @@ class Queries(object):
         endCursor
       }}
       nodes {{
-        nameWithOwner
-        stargazers {{
-          totalCount
-        }}
-        forkCount
-        languages(first: 10, orderBy: {{field: SIZE, direction: DESC}}) {{
-          edges {{
-            size
-            node {{
-              name
-              color
-            }}
-          }}
-        }}
+        nameWithOwner{repo_details}
       }}
     }}
     repositoriesContributedTo(
@@ -157,32 +266,19 @@ class Queries(object):
         endCursor
       }}
       nodes {{
-        nameWithOwner
-        stargazers {{
-          totalCount
-        }}
-        forkCount
-        languages(first: 10, orderBy: {{field: SIZE, direction: DESC}}) {{
-          edges {{
-            size
-            node {{
-              name
-              color
-            }}
-          }}
-        }}
+        nameWithOwner{repo_details if contrib_details else ""}
       }}
     }}
   }}
 }}
-"""
+""")
 
     @staticmethod
     def contrib_years() -> str:
         """
         :return: GraphQL query to get all years the user has been a contributor
         """
-        return """
+        return Queries.minify("""
 query {
   viewer {
     contributionsCollection {
@@ -190,7 +286,7 @@ query {
     }
   }
 }
-"""
+""")
 
     @staticmethod
     def contribs_by_year(year: str) -> str:
@@ -198,7 +294,7 @@ query {
         :param year: year to query for
         :return: portion of a GraphQL query with desired info for a given year
         """
-        return f"""
+        return Queries.minify(f"""
     year{year}: contributionsCollection(
         from: "{year}-01-01T00:00:00Z",
         to: "{int(year) + 1}-01-01T00:00:00Z"
@@ -207,7 +303,7 @@ query {
         totalContributions
       }}
     }}
-"""
+""")
 
     @classmethod
     def all_contribs(cls, years: List[str]) -> str:
@@ -215,14 +311,14 @@ query {
         :param years: list of years to get contributions for
         :return: query to retrieve contribution information for all user years
         """
-        by_years = "\n".join(map(cls.contribs_by_year, years))
-        return f"""
+        by_years = " ".join(map(cls.contribs_by_year, years))
+        return cls.minify(f"""
 query {{
   viewer {{
     {by_years}
   }}
 }}
-"""
+""")
 
 
 class Stats(object):
@@ -233,12 +329,14 @@ class Stats(object):
                  session: aiohttp.ClientSession,
                  exclude_repos: Optional[Set] = None,
                  exclude_langs: Optional[Set] = None,
-                 consider_forked_repos: bool = False):
+                 consider_forked_repos: bool = False,
+                 cache_dir: Optional[str] = None):
         self.username = username
         self._exclude_repos = set() if exclude_repos is None else exclude_repos
         self._exclude_langs = set() if exclude_langs is None else exclude_langs
         self._consider_forked_repos = consider_forked_repos
-        self.queries = Queries(username, access_token, session)
+        self.queries = Queries(username, access_token, session,
+                               cache_dir=cache_dir)
 
         self._name = None
         self._stargazers = None
@@ -246,8 +344,10 @@ class Stats(object):
         self._total_contributions = None
         self._languages = None
         self._repos = None
+        self._ignored_repos = None
         self._lines_changed = None
-        self._views = None        
+        self._views = None
+        self._stats_task = None
 
     async def to_str(self) -> str:
         """
@@ -272,32 +372,47 @@ Languages:
 
     async def get_stats(self) -> None:
         """
-        Get lots of summary statistics using one big query. Sets many attributes
+        Get lots of summary statistics using one big query. Sets many
+        attributes; concurrent callers share a single in-flight request.
+        """
+        if self._stats_task is None:
+            self._stats_task = asyncio.ensure_future(self._fetch_stats())
+        await self._stats_task
+
+    async def _fetch_stats(self) -> None:
+        """
+        Run the summary statistics query. Results are collected locally and
+        only assigned once complete, so the properties never observe
+        partially filled attributes.
         """
-        self._stargazers = 0
-        self._forks = 0
-        self._languages = dict()
-        self._repos = set()
-        self._ignored_repos = set()
-        
+        name = None
+        stargazers = 0
+        forks = 0
+        languages = dict()
+        all_repos = set()
+        ignored_repos = set()
+
         next_owned = None
         next_contrib = None
         while True:
             raw_results = await self.queries.query(
-                Queries.repos_overview(owned_cursor=next_owned,
-                                       contrib_cursor=next_contrib)
+                Queries.repos_overview(
+                    owned_cursor=next_owned,
+                    contrib_cursor=next_contrib,
+                    contrib_details=self._consider_forked_repos
+                )
             )
             raw_results = raw_results if raw_results is not None else {}
 
-            self._name = (raw_results
-                          .get("data", {})
-                          .get("viewer", {})
-                          .get("name", None))
-            if self._name is None:
-                self._name = (raw_results
-                              .get("data", {})
-                              .get("viewer", {})
-                              .get("login", "No Name"))
+            name = (raw_results
+                    .get("data", {})
+                    .get("viewer", {})
+                    .get("name", None))
+            if name is None:
+                name = (raw_results
+                        .get("data", {})
+                        .get("viewer", {})
+                        .get("login", "No Name"))
 
             contrib_repos = (raw_results
                              .get("data", {})
@@ -313,28 +428,28 @@ Languages:
                 repos += contrib_repos.get("nodes", [])
             else:
                 for repo in contrib_repos.get("nodes", []):
-                    name = repo.get("nameWithOwner")
-                    if name in self._ignored_repos or name in self._exclude_repos:
+                    repo_name = repo.get("nameWithOwner")
+                    if (repo_name in ignored_repos
+                            or repo_name in self._exclude_repos):
                         continue
-                    self._ignored_repos.add(name)
+                    ignored_repos.add(repo_name)
 
             for repo in repos:
-                name = repo.get("nameWithOwner")
-                if name in self._repos or name in self._exclude_repos:
+                repo_name = repo.get("nameWithOwner")
+                if repo_name in all_repos or repo_name in self._exclude_repos:
                     continue
-                self._repos.add(name)
-                self._stargazers += repo.get("stargazers").get("totalCount", 0)
-                self._forks += repo.get("forkCount", 0)
+                all_repos.add(repo_name)
+                stargazers += repo.get("stargazers").get("totalCount", 0)
+                forks += repo.get("forkCount", 0)
 
                 for lang in repo.get("languages", {}).get("edges", []):
-                    name = lang.get("node", {}).get("name", "Other")
-                    languages = await self.languages
-                    if name in self._exclude_langs: continue
-                    if name in languages:
-                        languages[name]["size"] += lang.get("size", 0)
-                        languages[name]["occurrences"] += 1
+                    lang_name = lang.get("node", {}).get("name", "Other")
+                    if lang_name in self._exclude_langs: continue
+                    if lang_name in languages:
+                        languages[lang_name]["size"] += lang.get("size", 0)
+                        languages[lang_name]["occurrences"] += 1
                     else:
-                        languages[name] = {
+                        languages[lang_name] = {
                             "size": lang.get("size", 0),
                             "occurrences": 1,
                             "color": lang.get("node", {}).get("color")
@@ -353,10 +468,17 @@ Languages:
 
         # TODO: Improve languages to scale by number of contributions to
         #       specific filetypes
-        langs_total = sum([v.get("size", 0) for v in self._languages.values()])
-        for k, v in self._languages.items():
+        langs_total = sum(v.get("size", 0) for v in languages.values())
+        for k, v in languages.items():
             v["prop"] = 100 * (v.get("size", 0) / langs_total)
 
+        self._name = name
+        self._stargazers = stargazers
+        self._forks = forks
+        self._languages = languages
+        self._repos = all_repos
+        self._ignored_repos = ignored_repos
+
     @property
     async def name(self) -> str:
         """
@@ -468,8 +590,13 @@ Languages:
             return self._lines_changed
         additions = 0
         deletions = 0
-        for repo in await self.all_repos:
-            r = await self.queries.query_rest(f"/repos/{repo}/stats/contributors")
+        # Fetch all repositories concurrently; Queries.semaphore bounds the
+        # number of requests in flight
+        results = await asyncio.gather(*[
+            self.queries.query_rest(f"/repos/{repo}/stats/contributors")
+            for repo in await self.all_repos
+        ])
+        for r in results:
             for author_obj in r:
                 # Handle malformed response from the API by skipping this repo
                 if (not isinstance(author_obj, dict)
@@ -495,16 +622,32 @@ Languages:
         if self._views is not None:
             return self._views
 
-        total = 0
-        for repo in await self.repos:
-            r = await self.queries.query_rest(f"/repos/{repo}/traffic/views")
-            for view in r.get("views", []):
-                total += view.get("count", 0)
+        results = await asyncio.gather(*[
+            self.queries.query_rest(f"/repos/{repo}/traffic/views")
+            for repo in await self.repos
+        ])
+        total = sum(view.get("count", 0)
+                    for r in results for view in r.get("views", []))
 
         self._views = total
         return total
 
 
+###############################################################################
+# Helper Functions
+###############################################################################
+
+def create_session() -> aiohttp.ClientSession:
+    """
+    :return: HTTP session with a keep-alive connection pool and DNS cache
+             suited to making many requests to the GitHub API
+    """
+    connector = aiohttp.TCPConnector(limit_per_host=64, ttl_dns_cache=300,
+                                     keepalive_timeout=60)
+    return aiohttp.ClientSession(connector=connector,
+                                 timeout=aiohttp.ClientTimeout(total=30))
+
+
 ###############################################################################
 # Main Function
 ###############################################################################
@@ -515,8 +658,8 @@ async def main() -> None:
     """
     access_token = os.getenv("ACCESS_TOKEN")
     user = os.getenv("GITHUB_ACTOR")
-    async with aiohttp.ClientSession() as session:
-        s = Stats(user, access_token, session)
+    async with create_session() as session:
+        s = Stats(user, access_token, session, cache_dir=CACHE_DIR)
         print(await s.to_str())
 
 